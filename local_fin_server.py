@@ -1,11 +1,15 @@
 import os
 import sqlite3
-import time
 import json
+import queue
+import threading
+import functools
+import orjson
 import pandas as pd
 import numpy as np
 import yfinance as yf
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # ==========================================
 # 1. 配置区域
@@ -14,33 +18,71 @@ DATA_DIR = 'data'
 DB_FILENAME = 'financial_data_v20.db' # 升级到 V20
 DB_PATH = os.path.join(DATA_DIR, DB_FILENAME)
 
+# 【并发配置】yfinance 各属性都是独立的 HTTPS 请求，并发拉取
+MAX_WORKERS = 8
+# 写线程每攒够多少行提交一次事务
+WRITE_BATCH_SIZE = 128
+
 # 【代理配置】
 PROXY_URL = "http://127.0.0.1:10808"
 os.environ["HTTP_PROXY"] = PROXY_URL
 os.environ["HTTPS_PROXY"] = PROXY_URL
 
 # JSON 序列化辅助 (修复 NaN 问题)
+def _np_float(obj):
+    if np.isnan(obj): return None # 将 NaN 转为 null
+    return float(obj)
+
 class NpEncoder(json.JSONEncoder):
+    # 按 type(obj) 直接查表分派，代替逐个 isinstance 判断
+    # 表放在类上只建一次 (json.dumps 每次调用都会新建 encoder 实例)
+    _dispatch = {
+        **dict.fromkeys((np.int8, np.int16, np.int32, np.int64,
+                         np.uint8, np.uint16, np.uint32, np.uint64), int),
+        **dict.fromkeys((np.float16, np.float32, np.float64), _np_float),
+        np.ndarray: lambda obj: obj.tolist(),
+    }
+
     def default(self, obj):
+        handler = self._dispatch.get(type(obj))
+        if handler: return handler(obj)
+        # 表里没有的 numpy 类型 (如 longdouble、MaskedArray 等 ndarray 子类) 退回 isinstance 判断
         if isinstance(obj, np.integer): return int(obj)
-        if isinstance(obj, np.floating):
-            if np.isnan(obj): return None # 将 NaN 转为 null
-            return float(obj)
+        if isinstance(obj, np.floating): return _np_float(obj)
         if isinstance(obj, np.ndarray): return obj.tolist()
         return super(NpEncoder, self).default(obj)
 
+def dumps_financials(data):
+    """财报字典 -> JSON 字符串 (orjson 原生处理 numpy 标量，NaN 输出为 null)"""
+    try:
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS).decode()
+    except orjson.JSONEncodeError:
+        # orjson 不认识的类型退回 NpEncoder
+        return json.dumps(data, cls=NpEncoder)
+
 # ==========================================
 # 2. 数据库初始化
 # ==========================================
+def connect_db(**kwargs):
+    """打开数据库连接并应用写入优化 PRAGMA (WAL + 64MB 缓存)"""
+    conn = sqlite3.connect(DB_PATH, **kwargs)
+    conn.execute("PRAGMA journal_mode=WAL;")
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    conn.execute("PRAGMA cache_size=-65536;")
+    return conn
+
 def init_database():
     if not os.path.exists(DATA_DIR): os.makedirs(DATA_DIR)
     
     # 强制清理旧库，因为表结构变了
-    if os.path.exists(DB_PATH):
-        try: os.remove(DB_PATH)
-        except: pass
+    # WAL 模式下还要删掉 -wal/-shm，否则新库可能回放残留的旧日志
+    for path in (DB_PATH, DB_PATH + '-wal', DB_PATH + '-shm'):
+        if os.path.exists(path):
+            try: os.remove(path)
+            except: pass
 
-    conn = sqlite3.connect(DB_PATH)
+    conn = connect_db()
     c = conn.cursor()
     # 新增 fiscal_year, fiscal_quarter 字段
     c.execute('''CREATE TABLE IF NOT EXISTS historical_financials
@@ -56,22 +98,61 @@ def init_database():
                   market_cap_billions REAL,
                   financials_json TEXT,
                   data_source TEXT,
-                  updated_at TEXT)''')
+                  updated_at TEXT,
+                  UNIQUE(ticker, report_period, report_type))''')
     conn.commit()
     conn.close()
     print(f"✅ [Init] 数据库 V20 就绪: {DB_PATH}")
 
+def db_writer(conn, row_queue, errors, failed):
+    """
+    单写线程：从队列取行，每 WRITE_BATCH_SIZE 行开一个事务批量写入
+    收到 None 表示生产者已结束，写完剩余行后退出
+    查重交给 UNIQUE 约束 + INSERT OR IGNORE
+    写入出错时把异常放进 errors 并设置 failed，由主线程重新抛出
+    每次 COMMIT 后打印实际写入的行数 (被 IGNORE 的重复行不计)
+    """
+    batch = []
+
+    def flush():
+        if not batch: return
+        conn.execute("BEGIN IMMEDIATE")
+        changes_before = conn.total_changes
+        try:
+            conn.executemany('''INSERT OR IGNORE INTO historical_financials
+                                (ticker, announce_date, report_period, fiscal_year, fiscal_quarter, report_type,
+                                 adj_close_price, shares_outstanding, market_cap_billions,
+                                 financials_json, data_source, updated_at)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', batch)
+            conn.execute("COMMIT")
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        print(f"   💾 已提交 {conn.total_changes - changes_before}/{len(batch)} 条")
+        batch.clear()
+
+    try:
+        while True:
+            row = row_queue.get()
+            if row is None: break
+            batch.append(row)
+            if len(batch) >= WRITE_BATCH_SIZE: flush()
+        flush()
+    except Exception as e:
+        errors.append(e)
+        failed.set()
+
 # ==========================================
 # 3. 核心算法：财年/财季计算器
 # ==========================================
-def calculate_fiscal_context(ticker_obj, report_date):
+def calculate_fiscal_context(info, report_dates, ticker_symbol):
     """
-    根据公司的财年结束月，将 自然日期 转换为 财年/财季
+    根据公司的财年结束月，将一批 自然日期 转换为 财年/财季
     NVDA 案例: 财年结束 1月。Report 2025-10-31 -> FY2026 Q3
+    返回 (财年数组, 财季序号数组)，整批用 numpy 计算，无逐行分支
     """
     try:
-        # 获取财年结束信息
-        info = ticker_obj.info
+        # 获取财年结束信息 (info 由调用方预先取好，避免逐行请求)
         # lastFiscalYearEnd 是时间戳，转为月份
         fy_end_ts = info.get('lastFiscalYearEnd')
         
@@ -79,77 +160,169 @@ def calculate_fiscal_context(ticker_obj, report_date):
             fy_end_month = datetime.fromtimestamp(fy_end_ts).month
         else:
             # 默认兜底：NVDA=1, AAPL=9, MSFT=6
-            ticker_symbol = ticker_obj.ticker
             if ticker_symbol == 'NVDA': fy_end_month = 1
             elif ticker_symbol == 'AAPL': fy_end_month = 9
             elif ticker_symbol == 'MSFT': fy_end_month = 6
             else: fy_end_month = 12
-
-        r_year = report_date.year
-        r_month = report_date.month
-
-        # 逻辑：
-        # 如果 财年结束月是 12月 (正常): 财年 = 自然年
-        # 如果 财年结束月 < 报表月: 财年 = 自然年 + 1
-        
-        fiscal_year = r_year
-        if r_month > fy_end_month:
-            fiscal_year = r_year + 1
-        
-        # 计算季度
-        # 核心逻辑：计算当前月相对于财年开始月的偏移量
-        # 财年开始月 = fy_end_month + 1
-        months_offset = (r_month - fy_end_month + 12) % 12
-        if months_offset == 0: months_offset = 12
-        
-        q_num = (months_offset - 1) // 3 + 1
-        fiscal_quarter = f"Q{q_num}"
-        
-        return fiscal_year, fiscal_quarter
-
     except Exception:
         # 出错兜底：按自然年算
-        return report_date.year, f"Q{(report_date.month-1)//3+1}"
+        fy_end_month = 12
+
+    report_dates = pd.DatetimeIndex(report_dates)
+    r_years = report_dates.year.to_numpy()
+    r_months = report_dates.month.to_numpy()
+
+    # 逻辑：
+    # 如果 财年结束月是 12月 (正常): 财年 = 自然年
+    # 如果 财年结束月 < 报表月: 财年 = 自然年 + 1
+    fiscal_years = r_years + (r_months > fy_end_month)
+    
+    # 计算季度
+    # 核心逻辑：计算当前月相对于财年开始月的偏移量 (1~12)
+    # 财年开始月 = fy_end_month + 1
+    months_offset = (r_months - fy_end_month - 1) % 12 + 1
+    quarter_nums = (months_offset - 1) // 3 + 1
+    
+    return fiscal_years, quarter_nums
 
 # ==========================================
 # 4. 核心算法：历史股本回溯
 # ==========================================
-def get_historical_shares(tick, target_date):
+def get_historical_shares(tick, target_dates):
     """
-    通过 get_shares_full 获取具体时间点的历史股本
+    通过 get_shares_full 获取一批时间点的历史股本
     解决旧财报中 shares 为 NULL 的问题
+    整个日期范围只请求一次，再向量化查找每个日期最近的记录
     """
+    shares_list = [None] * len(target_dates)
+    if not target_dates: return shares_list
     try:
-        # 获取历史股本序列
-        shares_series = tick.get_shares_full(start=target_date - timedelta(days=90), 
-                                             end=target_date + timedelta(days=30))
+        # 获取覆盖所有日期的历史股本序列 (每个日期原窗口: 前 90 天 ~ 后 30 天)
+        shares_series = tick.get_shares_full(start=min(target_dates) - timedelta(days=90), 
+                                             end=max(target_dates) + timedelta(days=30))
+        
+        if shares_series is None or shares_series.empty:
+            return shares_list
         
-        if shares_series.empty:
-            return None
+        # 按时间查找要求索引唯一且有序
+        shares_series = shares_series[~shares_series.index.duplicated(keep='last')].sort_index()
         
-        # 找到离 target_date 最近的那个索引
-        # shares_series.index 包含时间信息
-        # 将 target_date 转为 timestamp 用于比较
-        target_ts = pd.Timestamp(target_date).tz_localize(shares_series.index.tz)
+        # 将 target_dates 转为与序列同时区的 timestamp 用于比较
+        target_ts = pd.DatetimeIndex(target_dates).tz_localize(shares_series.index.tz)
         
-        # 找最近的
-        closest_idx = shares_series.index.get_indexer([target_ts], method='nearest')[0]
-        shares = shares_series.iloc[closest_idx]
+        # 只在各自窗口 [target-90天, target+30天] 内找最近的记录
+        # 窗口内离 target 最近的点只可能是 target 左右相邻的两个点
+        idx = shares_series.index
+        lo = idx.searchsorted(target_ts - pd.Timedelta(days=90), side='left')
+        hi = idx.searchsorted(target_ts + pd.Timedelta(days=30), side='right')
+        pos = idx.searchsorted(target_ts, side='left')
+        left, right = pos - 1, pos
+        has_left, has_right = left >= lo, right < hi
         
-        return float(shares)
+        idx_ns, target_ns = idx.as_unit('ns').asi8, target_ts.as_unit('ns').asi8
+        left_c, right_c = np.clip(left, 0, len(idx) - 1), np.clip(right, 0, len(idx) - 1)
+        no_point = np.iinfo(np.int64).max
+        left_dist = np.where(has_left, target_ns - idx_ns[left_c], no_point)
+        right_dist = np.where(has_right, idx_ns[right_c] - target_ns, no_point)
+        # 距离相同取后一个点 (与 get_indexer(method='nearest') 一致)
+        closest_idx = np.where(left_dist < right_dist, left_c, right_c)
+        values = shares_series.to_numpy()[closest_idx]
+        
+        for i in np.flatnonzero(has_left | has_right):
+            shares_list[i] = float(values[i])
     except:
-        return None
+        pass
+    return shares_list
 
 # ==========================================
 # 5. 数据获取 (YFinance)
 # ==========================================
-def fetch_and_process_data(ticker):
+@functools.lru_cache(maxsize=1024)
+def _parse_date(date_str):
+    """'YYYY-MM-DD' -> datetime，同一日期串只解析一次"""
+    return datetime.strptime(date_str, '%Y-%m-%d')
+
+@functools.lru_cache(maxsize=None)
+def _ticker(symbol, session=None):
+    """进程内共享同一个 Ticker 实例，复用其内部已拉取的数据 (标的数量很少，不设上限)"""
+    return yf.Ticker(symbol, session=session)
+
+# 各报表的 timeseries key 名 -> 与 yfinance 公开属性一致的缩写规则
+_STATEMENT_ACRONYMS = [('financials', ["EBIT", "EBITDA", "EPS", "NI"]),
+                       ('balance-sheet', ["PPE"]),
+                       ('cash-flow', ["PPE"])]
+# 合并请求被确定性拒绝 (如 URL 过长) 后，本进程内不再尝试
+_combined_statements_failed = threading.Event()
+
+def _is_definite_rejection(e):
+    """
+    合并请求的失败是否是确定性的：HTTP 4xx、响应格式不对、或 yfinance 内部接口已变
+    超时/连接错误/5xx 属于偶发，只影响本次调用
+    """
+    status = getattr(getattr(e, 'response', None), 'status_code', None)
+    if status is not None: return 400 <= status < 500
+    return isinstance(e, (ValueError, KeyError, TypeError, AttributeError, ImportError))
+
+@functools.lru_cache(maxsize=128)
+def get_statements(symbol, freq):
+    """
+    一次请求取回 利润表/资产负债表/现金流量表 (freq: 'yearly' / 'quarterly')
+    三张表在 Yahoo 都走同一个 timeseries 接口，合并 key 后只需一次往返
+    依赖 yfinance 内部接口，失败或返回为空时退回并发逐表请求
+    """
+    tick = _ticker(symbol)
+    if not _combined_statements_failed.is_set():
+        try:
+            from yfinance import const, utils
+            # 每张表按自己的缩写规则转成可读行名 (如 'Ordinary Shares Number')，
+            # 同名 key 以先出现的报表为准 (利润表 > 资产负债表 > 现金流量表)
+            titles = {}
+            for name, acronyms in _STATEMENT_ACRONYMS:
+                raw_keys = [k for k in const.fundamentals_keys[name] if k not in titles]
+                titles.update(zip(raw_keys, utils.camel2title(raw_keys, sep=' ', acronyms=acronyms)))
+            df = tick._fundamentals.financials._get_financials_time_series(freq, list(titles)).copy()
+            if not df.empty:
+                df.index = df.index.map(lambda k: titles.get(k, k))
+                return df
+            # 返回为空可能只是该标的没有数据，只对本次调用退回逐表请求
+        except Exception as e:
+            if _is_definite_rejection(e):
+                _combined_statements_failed.set()
+                print(f"   ⚠️ 合并报表请求被拒绝，本次运行改为逐表请求: {e}")
+            else:
+                print(f"   ⚠️ {symbol} 合并报表请求失败，本次改为逐表请求: {e}")
+    # 逐表请求也并发发出，保持与合并请求相近的耗时
+    prefix = '' if freq == 'yearly' else 'quarterly_'
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        frames = list(pool.map(lambda attr: getattr(tick, prefix + attr),
+                               ('income_stmt', 'balance_sheet', 'cash_flow')))
+    return pd.concat(frames)
+
+def fetch_and_process_data(ticker, now=None):
     print(f"\nAnalyzing {ticker}...")
-    tick = yf.Ticker(ticker)
+    tick = _ticker(ticker)
+    # 当前时间只取一次 (run_v20 传入同一个时刻)，循环内复用
+    if now is None: now = datetime.now()
+    now_str = now.strftime('%Y-%m-%d')
+    now_ts = pd.Timestamp(now)
     
+    # 0. 并发拉取所有数据 (每项一次网络往返，串行等待太慢)
+    tasks = {
+        'Annual': lambda: get_statements(ticker, 'yearly'),
+        'Quarterly': lambda: get_statements(ticker, 'quarterly'),
+        'earnings_dates': lambda: tick.earnings_dates,
+        'info': lambda: tick.info,
+    }
+    fetched = {}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        futures = {pool.submit(task): name for name, task in tasks.items()}
+        for fut in as_completed(futures):
+            try: fetched[futures[fut]] = fut.result()
+            except: fetched[futures[fut]] = None
+
     # 1. 获取财报日历 (用于公告日)
     try:
-        calendar_df = tick.earnings_dates
+        calendar_df = fetched['earnings_dates']
         if calendar_df is not None:
             # 索引是发布日，将其转为字符串列表
             calendar_dates = [d.strftime('%Y-%m-%d') for d in calendar_df.index]
@@ -157,64 +330,64 @@ def fetch_and_process_data(ticker):
             calendar_dates = []
     except: calendar_dates = []
 
+    # 基础信息只取一次，后续财年计算与股本兜底都复用
+    info = fetched.get('info') or {}
+
     # 2. 获取原始报表
     results = []
     
     # 获取所有可能的报表
-    tables = [
-        (tick.income_stmt.T, 'Annual'), 
-        (tick.quarterly_income_stmt.T, 'Quarterly'),
-        (tick.balance_sheet.T, 'Annual'),
-        (tick.quarterly_balance_sheet.T, 'Quarterly'),
-        (tick.cash_flow.T, 'Annual'),
-        (tick.quarterly_cash_flow.T, 'Quarterly')
-    ]
+    tables = []
+    for r_type in ('Annual', 'Quarterly'):
+        df = fetched.get(r_type)
+        if df is None: continue
+        tables.append((df.T, r_type))
 
     # 合并同类项 (按日期和类型)
-    merged_data = {} # Key: (date, type) -> Value: dict
-    
-    for df, r_type in tables:
-        if df.empty: continue
-        for dt, row in df.iterrows():
-            # 处理日期和时区
-            r_date = dt.tz_localize(None) if hasattr(dt, 'tz') and dt.tz else dt
-            if not isinstance(r_date, datetime): r_date = pd.to_datetime(r_date)
-            if r_date > datetime.now(): continue # 过滤未来
-
-            key = (r_date, r_type)
-            if key not in merged_data:
-                merged_data[key] = {}
-            
-            # 累加数据
-            row_dict = row.to_dict()
-            merged_data[key].update(row_dict)
+    # 打上类型标签后整体 concat，再按 (日期, 类型) groupby 取首个非空值
+    frames = [df.assign(_rtype=r_type) for df, r_type in tables if not df.empty]
+    if not frames: return []
+    merged = pd.concat(frames)
+
+    # 处理日期和时区
+    report_idx = pd.to_datetime(merged.index)
+    if report_idx.tz is not None: report_idx = report_idx.tz_localize(None)
+    merged.index = report_idx.rename('report_date')
+    merged = merged[merged.index <= now_ts] # 过滤未来
+
+    merged = (merged.reset_index()
+                    .groupby(['report_date', '_rtype'], as_index=False, sort=False)
+                    .first())
+    item_cols = merged.columns[2:].tolist()
+    fiscal_years, quarter_nums = calculate_fiscal_context(info, merged['report_date'], ticker)
+
+    # 3. 公告日匹配 (向量化)
+    # 逻辑：公告日通常在截止日后 15-90 天，取窗口内最近的日历日期
+    # 一次广播算出 报表 x 日历 的天数差矩阵，代替逐行嵌套循环
+    matched_ann = [None] * len(merged)
+    if calendar_dates and not merged.empty:
+        cal_arr = pd.to_datetime(calendar_dates).values.astype('datetime64[D]')
+        report_arr = merged['report_date'].values.astype('datetime64[D]')
+        diff = (cal_arr[None, :] - report_arr[:, None]).astype('int32')
+        in_window = (diff >= 10) & (diff <= 100)
+        best = np.where(in_window, diff, np.iinfo(np.int32).max).argmin(axis=1)
+        for i in np.flatnonzero(in_window.any(axis=1)):
+            matched_ann[i] = calendar_dates[best[i]]
 
-    # 3. 处理每一条汇总数据
+    # 4. 处理每一条汇总数据
     final_list = []
-    for (r_date, r_type), data_dict in merged_data.items():
+    for i, row in enumerate(merged.itertuples(index=False, name=None)):
+        r_date, r_type = row[0], row[1]
+        # concat 后每行都带上所有报表/类型的列，空值单元格说明该日期没有这一项，
+        # 必须剔除：否则 NaN 股本为真值，会跳过后面的历史股本/当前股本兜底
+        data_dict = {k: v for k, v in zip(item_cols, row[2:]) if pd.notna(v)}
         # A. 计算财年/财季 (NVDA 修正逻辑)
-        if r_type == 'Annual':
-            fy, fq = calculate_fiscal_context(tick, r_date)
-            fq = "FY" # 年报统一显示 FY
-        else:
-            fy, fq = calculate_fiscal_context(tick, r_date)
+        fy = int(fiscal_years[i])
+        fq = "FY" if r_type == 'Annual' else f"Q{quarter_nums[i]}" # 年报统一显示 FY
         
         # B. 确定公告日 (Announce Date)
         r_date_str = r_date.strftime('%Y-%m-%d')
-        ann_date_str = None
-        
-        # 在日历中找匹配
-        # 逻辑：公告日通常在截止日后 15-90 天
-        best_diff = 999
-        r_dt_obj = r_date.to_pydatetime()
-        
-        for cal_d_str in calendar_dates:
-            cal_dt = datetime.strptime(cal_d_str, '%Y-%m-%d')
-            diff = (cal_dt - r_dt_obj).days
-            if 10 <= diff <= 100:
-                if diff < best_diff:
-                    best_diff = diff
-                    ann_date_str = cal_d_str
+        ann_date_str = matched_ann[i]
         
         if not ann_date_str:
             # 找不到就估算
@@ -222,21 +395,13 @@ def fetch_and_process_data(ticker):
             ann_date_str = (r_date + timedelta(days=offset)).strftime('%Y-%m-%d')
         
         # 修正：公告日不能是未来
-        if datetime.strptime(ann_date_str, '%Y-%m-%d') > datetime.now():
-            ann_date_str = datetime.now().strftime('%Y-%m-%d')
+        if ann_date_str > now_str: # 'YYYY-MM-DD' 字符串序即日期序
+            ann_date_str = now_str
 
         # C. 获取股本 (三级策略：报表 -> 历史序列 -> 当前)
         shares = data_dict.get('Ordinary Shares Number')
         if not shares: shares = data_dict.get('Share Issued')
         
-        # 如果报表里没有，去历史序列里查 (修复 NULL 关键)
-        if not shares:
-            shares = get_historical_shares(tick, datetime.strptime(ann_date_str, '%Y-%m-%d'))
-            
-        # 如果还没有，用当前兜底 (但标记一下)
-        if not shares:
-            shares = tick.info.get('sharesOutstanding')
-        
         final_list.append({
             'report_period': r_date_str,
             'announce_date': ann_date_str,
@@ -247,83 +412,108 @@ def fetch_and_process_data(ticker):
             'data': data_dict
         })
     
+    # 如果报表里没有，去历史序列里查 (修复 NULL 关键)，所有缺失日期合并成一次请求
+    missing = [item for item in final_list if not item['shares']]
+    if missing:
+        hist_shares = get_historical_shares(tick, [_parse_date(item['announce_date']) for item in missing])
+        for item, shares in zip(missing, hist_shares):
+            # 如果还没有，用当前兜底 (但标记一下)
+            item['shares'] = shares or info.get('sharesOutstanding')
+    
     return final_list
 
 # ==========================================
 # 6. 股价获取 (复权)
 # ==========================================
-def get_price(ticker, date_str):
+def download_prices(targets):
+    """一次请求批量下载所有 ticker 的全量复权股价 (auto_adjust=True)"""
+    return yf.download(' '.join(targets), period='max', auto_adjust=True,
+                       group_by='ticker', threads=True, progress=False)
+
+def get_price(close_series, date_str):
+    """在预先下载的收盘价序列中查找离 date_str 最近 (±10 天内) 的价格"""
     try:
-        dt = datetime.strptime(date_str, '%Y-%m-%d')
-        if dt > datetime.now(): dt = datetime.now() - timedelta(days=1)
-        
-        start = dt - timedelta(days=10)
-        end = dt + timedelta(days=10)
-        
-        # auto_adjust=True 拿到复权价
-        hist = yf.Ticker(ticker).history(start=start, end=end)
-        if hist.empty: return None
+        if close_series is None or close_series.empty: return None
         
-        target_ts = pd.Timestamp(date_str).tz_localize(hist.index.tz)
+        target_ts = pd.Timestamp(date_str).tz_localize(close_series.index.tz)
         
         # 找最近的收盘价
-        idx = hist.index.get_indexer([target_ts], method='nearest')[0]
-        return float(hist.iloc[idx]['Close'])
+        idx = close_series.index.get_indexer([target_ts], method='nearest',
+                                             tolerance=pd.Timedelta(days=10))[0]
+        if idx < 0: return None
+        return float(close_series.iloc[idx])
     except: return None
 
 # ==========================================
 # 7. 主流程
 # ==========================================
-def run_v20():
-    init_database()
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    targets = ['AAPL', 'NVDA', 'MSFT']
+def process_ticker(t, prices_future, now, row_queue, existing, writer_failed):
+    """抓取并处理单个 ticker，生成的行交给写线程入库 (写线程已失败则停止)"""
+    data_list = fetch_and_process_data(t, now)
+    now_str = now.strftime('%Y-%m-%d')
+    try: close_series = prices_future.result()[t]['Close'].dropna()
+    except: close_series = None
+    # 按时间倒序
+    data_list.sort(key=lambda x: x['report_period'], reverse=True)
     
-    for t in targets:
-        data_list = fetch_and_process_data(t)
-        # 按时间倒序
-        data_list.sort(key=lambda x: x['report_period'], reverse=True)
+    count = 0
+    for item in data_list:
+        if writer_failed.is_set(): break
+        # 查重 (内存集合，已入库的不再取价/序列化)
+        if (t, item['report_period'], item['report_type']) in existing: continue
+
+        price = get_price(close_series, item['announce_date'])
+        shares = item['shares']
         
-        count = 0
-        for item in data_list:
-            # 查重 (增加 fiscal_quarter 维度)
-            exists = c.execute("SELECT id FROM historical_financials WHERE ticker=? AND report_period=? AND report_type=?", 
-                             (t, item['report_period'], item['report_type'])).fetchone()
-            if exists: continue
-
-            price = get_price(t, item['announce_date'])
-            shares = item['shares']
+        if price and shares:
+            mkt_cap = price * shares
+            json_str = dumps_financials(item['data'])
+            
+            # 打印日志，着重显示财年信息
+            fy_info = f"FY{item['fiscal_year']} {item['fiscal_quarter']}"
             
-            if price and shares:
-                mkt_cap = price * shares
-                # 使用 NpEncoder 清洗 json
-                json_str = json.dumps(item['data'], cls=NpEncoder)
-                
-                # 打印日志，着重显示财年信息
-                fy_info = f"FY{item['fiscal_year']} {item['fiscal_quarter']}"
-                
-                c.execute('''INSERT INTO historical_financials 
-                             (ticker, announce_date, report_period, fiscal_year, fiscal_quarter, report_type,
-                              adj_close_price, shares_outstanding, market_cap_billions, 
-                              financials_json, data_source, updated_at)
-                             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                          (t, item['announce_date'], item['report_period'], 
+            row_queue.put((t, item['announce_date'], item['report_period'],
                            item['fiscal_year'], item['fiscal_quarter'], item['report_type'],
-                           price, shares, mkt_cap / 1e9, 
-                           json_str, "YFinance_V20", datetime.now().strftime('%Y-%m-%d')))
-                
-                print(f"   ✅ {t} {item['report_period']} -> {fy_info} | 市值 ${mkt_cap/1e9:.2f}B | 股本 {shares/1e9:.2f}B")
-                count += 1
-            else:
-                print(f"   ⚠️ {t} {item['report_period']} 缺失数据: Price={price}, Shares={shares}")
+                           price, shares, mkt_cap / 1e9,
+                           json_str, "YFinance_V20", now_str))
+            
+            print(f"   📥 {t} {item['report_period']} (已入队) -> {fy_info} | 市值 ${mkt_cap/1e9:.2f}B | 股本 {shares/1e9:.2f}B")
+            count += 1
+        else:
+            print(f"   ⚠️ {t} {item['report_period']} 缺失数据: Price={price}, Shares={shares}")
 
-        print(f"   -> 入库 {count} 条")
-        time.sleep(1)
-        
-    conn.commit()
-    conn.close()
+    print(f"   -> {t} 入队 {count} 条 (实际写入以 💾 已提交 为准)")
+
+def run_v20():
+    init_database()
+    # 连接交给写线程使用，事务由 db_writer 自己管理
+    conn = connect_db(check_same_thread=False, isolation_level=None)
+    
+    targets = ['AAPL', 'NVDA', 'MSFT']
+    now = datetime.now() # 整个运行共用一个时刻
+
+    # 已入库的记录一次查出，代替逐行 SELECT
+    # 注意：init_database 每次都会删库重建，当前这里总是空集合；
+    # 只有保留库跨次运行时才会真正跳过已入库的行，否则查重完全靠 INSERT OR IGNORE
+    existing = set(conn.execute("SELECT ticker, report_period, report_type FROM historical_financials").fetchall())
+
+    # SQLite 只有一个写者：抓取线程只往队列里放行，由单个写线程入库
+    row_queue = queue.Queue()
+    writer_errors = []
+    writer_failed = threading.Event()
+    writer = threading.Thread(target=db_writer, args=(conn, row_queue, writer_errors, writer_failed))
+    writer.start()
+
+    # 各 ticker 并发抓取 (股价一次性批量下载)
+    try:
+        with ThreadPoolExecutor(max_workers=len(targets) + 1) as pool:
+            prices_future = pool.submit(download_prices, targets)
+            list(pool.map(lambda t: process_ticker(t, prices_future, now, row_queue, existing, writer_failed), targets))
+    finally:
+        row_queue.put(None)
+        writer.join()
+        conn.close()
+    if writer_errors: raise writer_errors[0]
     print(f"\n🏁 完成。请检查数据库中的 'fiscal_year' 和 'fiscal_quarter' 列。")
 
 if __name__ == "__main__":